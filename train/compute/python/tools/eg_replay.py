@@ -1,9 +1,14 @@
 import argparse
 import gc
+import heapq
 import json
+import re
 import time
-from collections import defaultdict
-from functools import reduce
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from math import prod
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, List, Optional, Tuple
 
 import torch
 from param_bench.train.compute.python.tools.eg_replay_utils import (
@@ -11,7 +16,7 @@ from param_bench.train.compute.python.tools.eg_replay_utils import (
     is_backward_aten,
 )
 from param_bench.train.compute.python.tools.execution_graph import NodeType
-from torch.profiler import ExecutionGraphObserver
+from torch.profiler import ExecutionGraphObserver, ProfilerAction
 
 from ..lib import pytorch as lib_pytorch
 from ..lib.init_helper import load_modules
@@ -23,6 +28,7 @@ from .eg_replay_utils import (
     generate_fbgemm_tensors,
     get_input_tensors,
     get_output_tensors,
+    has_out_overload,
     is_fbgemm_backward,
     is_fbgemm_forward,
     is_fbgemm_forward_unweighted,
@@ -36,20 +42,137 @@ from .eg_replay_utils import (
 from .execution_graph import ExecutionGraph
 
 
+# Ops that allocate host memory or synchronize with the host, and so cannot be captured into a CUDA graph
+CUDA_GRAPH_UNSUPPORTED_OPS = {
+    "aten::pin_memory",
+    "aten::item",
+    "aten::_local_scalar_dense",
+    "aten::nonzero",
+}
+
+
+# Dispatch kinds of nodes, ops other than NORMAL_OP need special handling in run_op
+NORMAL_OP = 0
+CONV_BACKWARD_OP = 1
+MUL_OP = 2
+FBGEMM_FORWARD_OP = 3
+
+# output_mask argument of aten::convolution_backward, TorchScript copies list arguments so
+# a single instance can be shared by all calls
+CONV_BACKWARD_OUTPUT_MASK = [True, True, True]
+
+
+# Ops whose inputs are kept in float32 when instantiated tensors are cast to a lower precision
+CAST_EXCLUDED_OPS = {
+    "aten::softmax",
+    "aten::_softmax",
+    "aten::log_softmax",
+    "aten::_log_softmax",
+    "aten::layer_norm",
+    "aten::native_layer_norm",
+    "aten::batch_norm",
+    "aten::native_batch_norm",
+}
+
+
+def get_op_kind(node):
+    if is_fbgemm_forward(node):
+        return FBGEMM_FORWARD_OP
+    if node.name == "aten::convolution_backward":
+        return CONV_BACKWARD_OP
+    if node.name == "aten::mul":
+        return MUL_OP
+    return NORMAL_OP
+
+
+def flatten_outputs(result, output_count):
+    """
+        Flatten the result of an op into the list of its output tensors, tensor lists are expanded in place.
+    """
+    if output_count == 0:
+        return []
+    if output_count == 1:
+        # Common case: a single tensor output
+        if isinstance(result, torch.Tensor):
+            return [result]
+        result = (result,)
+    outputs = []
+    for x in result:
+        if isinstance(x, list) and x and isinstance(x[0], torch.Tensor):
+            outputs.extend(x)
+        elif isinstance(x, torch.Tensor):
+            outputs.append(x)
+    return outputs
+
+
+@dataclass
+class NodeReplayPlan:
+    """
+        Per node replay information that does not change across iterations, precomputed
+        once in preprocess_graph so run_op does not have to inspect the node again.
+    """
+    __slots__ = (
+        "func",
+        "output_count",
+        "input_template",
+        "tensor_slots",
+        "tensor_list_slots",
+        "output_writebacks",
+        "kind",
+        "upcast",
+        "stream_id",
+        "wait_on",
+    )
+    func: Optional[Callable]
+    output_count: int
+    # Input arguments with constants already filled in, tensor positions are filled from the
+    # registry at each call using the slots below.
+    input_template: List[Any]
+    # (argument position, replay_t_id) of each tensor argument
+    tensor_slots: List[Tuple[int, int]]
+    # (argument position, [replay_t_id, ...]) of each tensor list argument
+    tensor_list_slots: List[Tuple[int, List[int]]]
+    # One entry per output tensor: the replay_t_id to write the output to, or None if the
+    # output should not be written back to the registry.
+    output_writebacks: List[Optional[int]]
+    # One of the *_OP dispatch kinds
+    kind: int
+    # Set during replay on ops that fail with low precision inputs, their inputs are cast back
+    # to float32 on top of the workaround for the kind
+    upcast: bool
+    # Index of the stream the node is dispatched on when replaying with multiple streams
+    stream_id: int
+    # Indices (in sorted_nodes) of the nodes on other streams that the node has to wait for
+    wait_on: List[int]
+
+
 class ExgrReplayManager:
     def __init__(self, exgr, args):
         with open(exgr, 'r') as f:
             self.exgr = ExecutionGraph(json.load(f))
         self.numWarmupIters = args.warmup
         self.numIters = args.iter
+        self.presleep = args.presleep
         self.profile_replay = args.profile_replay
         self.profile_memory = args.profile_memory
+        self.record_shapes = args.record_shapes
+        self.per_iter_timing = args.per_iter_timing
+        self.buffer_pool = args.buffer_pool
+        self.cuda_graph = args.cuda_graph
+        self.num_streams = args.num_streams
+        # Lower precision float32 instantiated tensors are cast to, if any
+        self.cast_dtype = torch.float16 if args.cast_fp16 else (torch.bfloat16 if args.cast_bf16 else None)
+        self.codegen = args.codegen
+        # Set while capturing a CUDA graph, op errors are raised to capture_cuda_graph instead of exiting
+        self.capturing = False
 
         # Permanent
         self.tensor_registry_permanent = {}
         self.dependency_permanent = defaultdict(int)
         self.sorted_nodes = []
         self.funcs = {}
+        # Replay plan of each node, in the same order as sorted_nodes
+        self.replay_plans = []
         # Mark some intermediate tensors (output of operators) as unchangeable
         self.unchangeable_intermediate_tensors = set()
         # Unique tensors in execution graph identified by [tensor_id, storage_id, offset, num_elem, elem_bytes]
@@ -62,6 +185,8 @@ class ExgrReplayManager:
         self.tensors_mapping = {}
         # Dict that stores the shape of each unique tensor in replay
         self.replay_tensors_shapes = {}
+        # Dict that stores the eg storage id of each unique tensor in replay, views of a tensor share its storage id
+        self.replay_tensors_storage = {}
         # Dict that stores the shapes of a tensor that has appeared, for the convenience of quickly determining whether
         # to create a unique tensor in replay if the identifier is same but shape is different
         self.tensor_shapes = defaultdict(set)
@@ -70,10 +195,18 @@ class ExgrReplayManager:
         self.instantiate = set()
         # Tensors that should be instantiated on cpu, e.g., input of aten::pin_memory and aten::to
         self.cpu_tensor = set()
+        # Preallocated buffers that ops write their outputs to through their out= overloads when the
+        # buffer pool is enabled, replay tensors whose live ranges do not overlap share the same storage
+        self.output_buffers = {}
+        # CUDA streams independent ops are dispatched on, and the event recorded after each node
+        # that a node on another stream depends on (None for the other nodes)
+        self.streams = []
+        self.stream_events = []
         # Temporary
         self.tensor_registry = {}
         # Skip the node if their names contain any of the following strings.
         self.skip_node_names = ["DataLoader", "aten::set_"]
+        self.skip_node_re = re.compile("|".join(re.escape(name) for name in self.skip_node_names))
 
         if self.profile_memory:
             self.current_allocated_mem = 0
@@ -91,70 +224,77 @@ class ExgrReplayManager:
 
 
     def reset_registry(self):
-        self.tensor_registry = {k: (None if v is None else (v if k in self.cpu_tensor else v.cuda(self.cuda))) for k, v in self.tensor_registry_permanent.items()}
-        gc.collect()
-        torch.cuda.empty_cache()
+        # Permanent tensors are allocated on their target device, only the mapping needs to be copied
+        self.tensor_registry = dict(self.tensor_registry_permanent)
 
 
     def extract_subgraph(self, root):
         """
             return: all nodes in the subgraph, in the order of node ID
         """
-        def _dfs_traverse(root):
-            for child in root.children:
-                try:
-                    if any(x in child.name for x in self.skip_node_names):
-                        continue
+        skip_search = self.skip_node_re.search
+        append = self.sorted_nodes.append
+        # Explicit stack instead of recursion, children are pushed in reverse so that nodes are
+        # visited in the same pre-order as a recursive DFS (fbgemm backward funcs rely on it)
+        stack = list(reversed(root.children))
+        while stack:
+            child = stack.pop()
+            try:
+                if skip_search(child.name):
+                    continue
 
-                    if is_qualified(child):
-                        self.sorted_nodes.append(child)
+                if is_qualified(child):
+                    append(child)
 
-                        self.top_tensors[child] = set()
-                        for _, t_id, _ in get_input_tensors(child):
-                            self.top_tensors[child].add(t_id)
-                        for _, t_id, _ in get_output_tensors(child):
-                            self.top_tensors[child].add(t_id)
+                    self.top_tensors[child] = set()
+                    for _, t_id, _ in get_input_tensors(child):
+                        self.top_tensors[child].add(t_id)
+                    for _, t_id, _ in get_output_tensors(child):
+                        self.top_tensors[child].add(t_id)
 
-                        # Tensors dependency
-                        for _, t_id, _ in get_input_tensors(child):
-                            self.dependency_permanent[t_id] += 1
+                    # Tensors dependency
+                    for _, t_id, _ in get_input_tensors(child):
+                        self.dependency_permanent[t_id] += 1
 
-                        # Build aten funcs
-                        func, output_count = self.build_func(child)
-                        self.funcs[child.id] = (func, output_count)
-                    else:
-                        _dfs_traverse(child)
-                except Exception as e:
-                    print(f"Graph parse error: {e}, node id: {child.id}")
-                    exit(1)
+                    # Build aten funcs
+                    func, output_count = self.build_func(child)
+                    self.funcs[child.id] = (func, output_count)
+                else:
+                    stack.extend(reversed(child.children))
+            except Exception as e:
+                print(f"Graph parse error: {e}, node id: {child.id}")
+                exit(1)
 
-        _dfs_traverse(root)
-        self.sorted_nodes = sorted(self.sorted_nodes, key=lambda x: x.id)
+        # Frozen after this point, nothing mutates sorted_nodes during replay
+        self.sorted_nodes = tuple(sorted(self.sorted_nodes, key=attrgetter("id")))
         print("#Operations to execute: ", len(self.sorted_nodes))
 
 
     def analyze_subgraph(self, root):
-        def _bfs_traverse(node):
-            for child in node.children:
-                if any(x in child.name for x in self.skip_node_names):
-                    continue
+        skip_search = self.skip_node_re.search
+        # top_tensors is keyed by the nodes in sorted_nodes, use it for O(1) membership tests
+        top_tensors = self.top_tensors
+        queue = deque(root.children)
+        while queue:
+            child = queue.popleft()
+            if skip_search(child.name):
+                continue
+
+            if is_backward_aten(child) or has_backward_parent(child):
+                continue
+            else:
+                if child not in top_tensors and child.type == NodeType.OPERATOR:
+                    node = child.parent
+                    while (node not in top_tensors):
+                        node = node.parent
+                    for data_type, t_id, shape in get_output_tensors(child):
+                        if t_id not in top_tensors[node] and \
+                            t_id in self.dependency_permanent and t_id not in self.additional_tensors:
+                            self.additional_tensors.add(t_id)
+                            if shape:
+                                self.additional_tensors_size += prod(shape) * TORCH_DTYPES_BYTES[data_type[7:-1]]
+                queue.extend(child.children)
 
-                if is_backward_aten(child) or has_backward_parent(child):
-                    continue
-                else:
-                    if child not in self.sorted_nodes and child.type == NodeType.OPERATOR:
-                        node = child.parent
-                        while (node not in self.sorted_nodes):
-                            node = node.parent
-                        for data_type, t_id, shape in get_output_tensors(child):
-                            if t_id not in self.top_tensors[node] and \
-                                t_id in self.dependency_permanent and t_id not in self.additional_tensors:
-                                self.additional_tensors.add(t_id)
-                                if shape:
-                                    self.additional_tensors_size += reduce(lambda x,y:x*y, shape) * TORCH_DTYPES_BYTES[data_type.lstrip('Tensor(').rstrip(')')]
-                    _bfs_traverse(child)
-
-        _bfs_traverse(root)
         print(f"Additional allocated {len(self.additional_tensors)} tensors with total size of {self.additional_tensors_size/1024/1024}MB")
 
 
@@ -166,6 +306,7 @@ class ExgrReplayManager:
                 self.replay_unique_tensor_num += 1
                 self.tensors_mapping[(node_id, t_id)] = self.replay_unique_tensor_num
                 self.replay_tensors_shapes[self.tensors_mapping[(node_id, t_id)]] = shape
+                self.replay_tensors_storage[self.tensors_mapping[(node_id, t_id)]] = t_id[1]
                 self.tensor_shapes[t_id].add((self.tensors_mapping[(node_id, t_id)], tuple(shape)))
                 return
 
@@ -178,57 +319,76 @@ class ExgrReplayManager:
             self.replay_unique_tensor_num += 1
             self.tensors_mapping[(node_id, t_id)] = self.replay_unique_tensor_num
             self.replay_tensors_shapes[self.tensors_mapping[(node_id, t_id)]] = shape
+            self.replay_tensors_storage[self.tensors_mapping[(node_id, t_id)]] = t_id[1]
             self.tensor_shapes[t_id].add((self.tensors_mapping[(node_id, t_id)], tuple(shape)))
 
 
+        # Single pass: map tensors to unique replay tensors and simulate the execution progress,
+        # recording the output tensors we have seen so far
+        dep = self.dependency_permanent
+        tensors_mapping = self.tensors_mapping
+        output_set = set()
         for node in self.sorted_nodes:
+            input_ids = []
             for _, t_id, shape in get_input_tensors(node):
-                if t_id in self.dependency_permanent.keys():
+                if t_id in dep:
                     add_unique_tensor(node.id, t_id, shape)
+                    input_ids.append(t_id)
 
+            output_ids = []
             for _, t_id, shape in get_output_tensors(node):
-                if t_id in self.dependency_permanent.keys():
+                if t_id in dep:
                     add_unique_tensor(node.id, t_id, shape)
+                    output_ids.append(t_id)
 
-        # Simulate the execution progress and record the output tensors we have seen so far
-        output_set = set()
-        for node in self.sorted_nodes:
-            for _, t_id, _ in get_input_tensors(node):
-                if t_id in self.dependency_permanent.keys() and self.tensors_mapping[(node.id, t_id)] not in output_set:
-                    self.instantiate.add(self.tensors_mapping[(node.id, t_id)])
-
-            for _, t_id, _ in get_output_tensors(node):
-                if t_id in self.dependency_permanent.keys():
-                    output_set.add(self.tensors_mapping[(node.id, t_id)])
+            # Check inputs only after the outputs are mapped, an output may remap a (node id, tensor)
+            # pair that is also an input of the same node
+            for t_id in input_ids:
+                replay_t_id = tensors_mapping[(node.id, t_id)]
+                if replay_t_id not in output_set:
+                    self.instantiate.add(replay_t_id)
+            for t_id in output_ids:
+                output_set.add(tensors_mapping[(node.id, t_id)])
 
 
     def allocate_tensors(self):
+        dep = self.dependency_permanent
+        tensors_mapping = self.tensors_mapping
+        registry = self.tensor_registry_permanent
         # Instantiation of tensors:
         for node in self.sorted_nodes:
-            if is_fbgemm_forward(node):
+            fbgemm_forward = is_fbgemm_forward(node)
+            if fbgemm_forward:
                 input_args, _ = generate_fbgemm_tensors(node)
             for idx, (data_type, t_id, shape) in enumerate(get_input_tensors(node)):
-                replay_t_id = self.tensors_mapping[(node.id, t_id)]
-                if t_id in self.dependency_permanent.keys() and \
-                        replay_t_id not in self.tensor_registry_permanent.keys() and \
+                replay_t_id = tensors_mapping[(node.id, t_id)]
+                if t_id in dep and \
+                        replay_t_id not in registry and \
                         (node.name == "aten::embedding_bag" or node.name == "fbgemm::split_embedding_codegen_lookup_sgd_function" \
                         or replay_t_id in self.instantiate):
                     try:
-                        if is_fbgemm_forward(node):
-                            self.tensor_registry_permanent[replay_t_id] = input_args[idx]
+                        if fbgemm_forward:
+                            registry[replay_t_id] = input_args[idx]
                             if node.name == "fbgemm::split_embedding_codegen_lookup_sgd_function":
                                 self.unchangeable_intermediate_tensors.add(replay_t_id)
                         else:
-                            dtype, rng = TORCH_DTYPES_RNG[data_type.lstrip('Tensor(').rstrip(')')]
-                            self.tensor_registry_permanent[replay_t_id] = rng(shape).to(dtype)
-                            if node.name == "aten::embedding_bag":
-                                self.unchangeable_intermediate_tensors.add(replay_t_id)
+                            # Strip "Tensor(" and ")", e.g. Tensor(float) -> float
+                            dtype, rng = TORCH_DTYPES_RNG[data_type[7:-1]]
                             if node.name == "aten::pin_memory" and idx == 0:
+                                # Keep it in pageable memory, pinning it would turn aten::pin_memory into a no-op
+                                registry[replay_t_id] = rng(shape, dtype=dtype)
                                 self.cpu_tensor.add(replay_t_id)
+                            else:
+                                if self.cast_dtype is not None and dtype == torch.float32 and node.name not in CAST_EXCLUDED_OPS:
+                                    dtype = self.cast_dtype
+                                # Generate directly on the GPU in the final dtype, so each tensor is allocated once
+                                registry[replay_t_id] = rng(shape, dtype=dtype, device=self.cuda)
+                            if node.name == "aten::embedding_bag":
+                                self.unchangeable_intermediate_tensors.add(replay_t_id)
                     except KeyError:
                         if data_type != 'Tensor(nullptr (uninitialized))':
                             print("KeyError: ", node.id, t_id, data_type)
-                        self.tensor_registry_permanent[replay_t_id] = None
+                        registry[replay_t_id] = None
 
             ######
             # Workaround to match offsets for embedding table
@@ -237,8 +397,11 @@ class ExgrReplayManager:
                 indices_tensor_shape = node.input_shapes[1][0]
                 offsets_tensor_shape = node.input_shapes[2][0]
                 nnz = indices_tensor_shape / offsets_tensor_shape
-                for i in range(offsets_tensor_shape):
-                   self.tensor_registry_permanent[self.tensors_mapping[(node.id, node.inputs[2])]][i] = i * nnz
+                offsets = registry[tensors_mapping[(node.id, tuple(node.inputs[2]))]]
+                # Offsets are i * nnz, generated with one kernel and truncated to the offsets dtype on copy
+                offsets[:offsets_tensor_shape].copy_(
+                    torch.arange(offsets_tensor_shape, dtype=torch.float64, device=offsets.device).mul_(nnz)
+                )
             ######
 
 
@@ -253,6 +416,229 @@ class ExgrReplayManager:
         return build_torchscript_func(node)
 
 
+    def build_input_plan(self, node):
+        """
+            return: input template, tensor slots and tensor list slots of the node's replay plan
+        """
+        tensors_mapping = self.tensors_mapping
+        input_template = []
+        tensor_slots = []
+        tensor_list_slots = []
+        if is_fbgemm_forward(node):
+            # Only the indices, offsets and (if weighted) per sample weights are passed to the fbgemm
+            # op, resolve their replay tensors here so replay does not touch the node inputs
+            for pos, idx in enumerate(fbgemm_input_args_indices(node)):
+                input_template.append(None)
+                tensor_slots.append((pos, tensors_mapping[(node.id, tuple(node.inputs[idx]))]))
+            if is_fbgemm_forward_unweighted(node):
+                input_template.append(None)
+            return input_template, tensor_slots, tensor_list_slots
+
+        for idx, item in enumerate(node.inputs):
+            if is_tensor(node, idx):
+                input_template.append(None)
+                tensor_slots.append((idx, tensors_mapping[(node.id, tuple(item))]))
+            elif is_tensor_list(node, idx):
+                input_template.append(None)
+                tensor_list_slots.append((idx, [tensors_mapping[(node.id, tuple(t_id))] for t_id in item]))
+            elif item == '<None>' or item == '<Generator>':
+                input_template.append(None)
+            elif item == 'inf' or item == '-inf':
+                input_template.append(float(item))
+            else:
+                input_template.append(item)
+        return input_template, tensor_slots, tensor_list_slots
+
+
+    def build_replay_plans(self):
+        for node in self.sorted_nodes:
+            func, output_count = self.funcs[node.id]
+            input_template, tensor_slots, tensor_list_slots = [], [], []
+            output_writebacks = []
+            # Nodes without a func are never executed, so there is nothing to resolve for them
+            if func:
+                try:
+                    input_template, tensor_slots, tensor_list_slots = self.build_input_plan(node)
+                except Exception as e:
+                    print("Inputs error: ", e, node.id)
+                    exit(1)
+
+                for _, t_id, _ in get_output_tensors(node):
+                    replay_t_id = None
+                    if t_id in self.dependency_permanent:
+                        replay_t_id = self.tensors_mapping[(node.id, t_id)]
+                        if replay_t_id in self.unchangeable_intermediate_tensors or replay_t_id in self.instantiate:
+                            replay_t_id = None
+                    output_writebacks.append(replay_t_id)
+
+            self.replay_plans.append(NodeReplayPlan(
+                func=func,
+                output_count=output_count,
+                input_template=input_template,
+                tensor_slots=tensor_slots,
+                tensor_list_slots=tensor_list_slots,
+                output_writebacks=output_writebacks,
+                kind=get_op_kind(node),
+                upcast=False,
+                stream_id=0,
+                wait_on=[],
+            ))
+
+
+    def allocate_output_buffers(self):
+        """
+            Preallocate the outputs of ops that have an out= overload. These ops are called through
+            the overload with their buffer as out, so they write in place instead of allocating a
+            new output every iteration.
+        """
+        # Live range [first write, last access] of each pooled replay tensor. Views of a pooled
+        # tensor are separate replay tensors backed by the same buffer, so accesses are tracked
+        # per storage and a buffer is only reused after the last access to any tensor on it.
+        storage = self.replay_tensors_storage
+        first_write = {}
+        last_access = {}
+        dtypes = {}
+        out_funcs = {}
+        for idx, (node, plan) in enumerate(zip(self.sorted_nodes, self.replay_plans)):
+            for _, replay_t_id in plan.tensor_slots:
+                last_access[storage[replay_t_id]] = idx
+            for _, replay_t_ids in plan.tensor_list_slots:
+                for replay_t_id in replay_t_ids:
+                    last_access[storage[replay_t_id]] = idx
+            for replay_t_id in plan.output_writebacks:
+                if replay_t_id is not None:
+                    last_access[storage[replay_t_id]] = idx
+            if plan.kind != NORMAL_OP or plan.output_count != 1 or len(plan.output_writebacks) != 1:
+                continue
+            replay_t_id = plan.output_writebacks[0]
+            data_type = get_output_tensors(node)[0][0]
+            if replay_t_id is None or replay_t_id in first_write or replay_t_id in self.tensor_registry_permanent \
+                    or data_type[7:-1] not in TORCH_DTYPES_RNG or not has_out_overload(node):
+                continue
+            func, _ = build_torchscript_func(node, out=True)
+            if not func:
+                continue
+            out_funcs[idx] = func
+            first_write[replay_t_id] = idx
+            dtypes[replay_t_id] = TORCH_DTYPES_RNG[data_type[7:-1]][0]
+            if self.cast_dtype is not None and dtypes[replay_t_id] == torch.float32 and node.name not in CAST_EXCLUDED_OPS:
+                dtypes[replay_t_id] = self.cast_dtype
+
+        starts = defaultdict(list)
+        ends = defaultdict(list)
+        for replay_t_id, idx in first_write.items():
+            starts[idx].append(replay_t_id)
+            ends[last_access[storage[replay_t_id]]].append(replay_t_id)
+
+        # Free lists of flat buffers keyed by (dtype, numel), a buffer goes back to its free list
+        # once the last op accessing the tensor it backs has run
+        free_buffers = defaultdict(list)
+        buffer_of = {}
+        buffer_count = 0
+        buffer_bytes = 0
+        for idx in range(len(self.replay_plans)):
+            for replay_t_id in starts[idx]:
+                shape = self.replay_tensors_shapes[replay_t_id]
+                key = (dtypes[replay_t_id], prod(shape))
+                if free_buffers[key]:
+                    buf = free_buffers[key].pop()
+                else:
+                    buf = torch.empty(key[1], dtype=key[0], device=self.cuda)
+                    buffer_count += 1
+                    buffer_bytes += buf.numel() * buf.element_size()
+                buffer_of[replay_t_id] = (key, buf)
+                self.output_buffers[replay_t_id] = buf.view(shape)
+                self.tensor_registry_permanent[replay_t_id] = self.output_buffers[replay_t_id]
+                plan = self.replay_plans[idx]
+                plan.func = out_funcs[idx]
+                plan.input_template = plan.input_template + [self.output_buffers[replay_t_id]]
+            for replay_t_id in ends[idx]:
+                key, buf = buffer_of[replay_t_id]
+                free_buffers[key].append(buf)
+
+        print(f"Buffer pool: {len(self.output_buffers)} output tensors backed by {buffer_count} buffers with total size of {buffer_bytes/1024/1024}MB")
+
+
+    def assign_streams(self):
+        """
+            Build the dependencies between nodes from the storages they read and write, and
+            assign nodes to streams level by level: nodes in the same level of the dependency DAG
+            are independent and go to different streams, preferring the stream of a predecessor.
+        """
+        num_streams = self.num_streams
+        plans = self.replay_plans
+        # Dependencies are tracked per storage rather than per replay tensor, so an in place op on
+        # a view is ordered with the reads and writes of its base and the other way around
+        storage = self.replay_tensors_storage
+        last_writer = {}
+        # Nodes that read a storage since it was last written
+        readers = defaultdict(list)
+        levels = [0] * len(plans)
+        used_streams = defaultdict(set)
+        last_fbgemm = None
+        need_event = set()
+        for idx, (node, plan) in enumerate(zip(self.sorted_nodes, plans)):
+            if not plan.func:
+                continue
+            reads = {storage[replay_t_id] for _, replay_t_id in plan.tensor_slots}
+            for _, replay_t_ids in plan.tensor_list_slots:
+                reads.update(storage[replay_t_id] for replay_t_id in replay_t_ids)
+            writes = {storage[self.tensors_mapping[(node.id, t_id)]] for _, t_id, _ in get_output_tensors(node) if t_id in self.dependency_permanent}
+
+            preds = set()
+            for storage_id in reads:
+                if storage_id in last_writer:
+                    preds.add(last_writer[storage_id])
+            for storage_id in writes:
+                if storage_id in last_writer:
+                    preds.add(last_writer[storage_id])
+                preds.update(readers[storage_id])
+            # fbgemm forward and backward share module state that is not visible as tensors
+            if plan.kind == FBGEMM_FORWARD_OP or is_fbgemm_backward(node):
+                if last_fbgemm is not None:
+                    preds.add(last_fbgemm)
+                last_fbgemm = idx
+            preds.discard(idx)
+
+            for storage_id in reads:
+                readers[storage_id].append(idx)
+            for storage_id in writes:
+                last_writer[storage_id] = idx
+                readers[storage_id] = []
+
+            level = max((levels[p] + 1 for p in preds), default=0)
+            levels[idx] = level
+            used = used_streams[level]
+            stream_id = None
+            for p in sorted(preds, reverse=True):
+                if plans[p].stream_id not in used:
+                    stream_id = plans[p].stream_id
+                    break
+            if stream_id is None:
+                free = [i for i in range(num_streams) if i not in used]
+                if free:
+                    stream_id = free[0]
+                elif preds:
+                    stream_id = plans[max(preds)].stream_id
+                else:
+                    stream_id = idx % num_streams
+            used.add(stream_id)
+
+            # Only the latest predecessor on each other stream needs to be waited for
+            waits = {}
+            for p in preds:
+                pred_stream_id = plans[p].stream_id
+                if pred_stream_id != stream_id and p > waits.get(pred_stream_id, -1):
+                    waits[pred_stream_id] = p
+            plan.stream_id = stream_id
+            plan.wait_on = sorted(waits.values())
+            need_event.update(plan.wait_on)
+
+        self.streams = [torch.cuda.Stream(device=self.cuda) for _ in range(num_streams)]
+        self.stream_events = [torch.cuda.Event() if idx in need_event else None for idx in range(len(plans))]
+        print(f"Dispatch ops on {num_streams} streams with {len(need_event)} cross stream dependencies")
+
+
     def preprocess_graph(self):
         nodes = self.exgr.get_nodes(clean=True)
         root_node = nodes[1] # 1-base
@@ -269,78 +655,101 @@ class ExgrReplayManager:
         print(f"Tensor count with same identifier but different shapes:{tensor_with_multiple_shape_count}, total tensor: {len(self.tensor_shapes)}")
 
         self.allocate_tensors()
+        self.build_replay_plans()
+        if self.buffer_pool:
+            self.allocate_output_buffers()
+        if self.num_streams > 1:
+            if self.buffer_pool:
+                # Pooled buffers are shared by tensors that are not tracked as dependencies
+                print("Multiple streams are not used together with the buffer pool")
+            else:
+                self.assign_streams()
         self.reset_registry()
+        gc.collect()
+        torch.cuda.empty_cache()
 
 
-    def get_inputs(self, node):
-        try:
-            if is_fbgemm_forward(node):
-                idx_list = fbgemm_input_args_indices(node)
-                inputs = [self.tensor_registry[self.tensors_mapping[(node.id, tuple(node.inputs[idx]))]] for idx in idx_list]
-                if is_fbgemm_forward_unweighted(node):
-                    inputs.append(None)
-            else:
-                inputs = []
-                for idx, item in enumerate(node.inputs):
-                    if is_tensor(node, idx):
-                        inputs.append(self.tensor_registry[self.tensors_mapping[(node.id, tuple(item))]])
-                    elif is_tensor_list(node, idx):
-                        inputs.append([self.tensor_registry[self.tensors_mapping[(node.id, tuple(t_id))]] for t_id in item])
-                    elif item == '<None>' or item == '<Generator>':
-                        inputs.append(None)
-                    elif item == 'inf' or item == '-inf':
-                        inputs.append(float(item))
-                    else:
-                        inputs.append(item)
-            return inputs
-        except Exception as e:
-            print("Inputs error: ", e, node.id)
+    def get_inputs(self, plan):
+        reg = self.tensor_registry
+        inputs = plan.input_template.copy()
+        for pos, replay_t_id in plan.tensor_slots:
+            inputs[pos] = reg[replay_t_id]
+        for pos, replay_t_ids in plan.tensor_list_slots:
+            inputs[pos] = [reg[replay_t_id] for replay_t_id in replay_t_ids]
+        return inputs
+
+
+    def upcast_inputs(self, inputs):
+        def _upcast(x):
+            if isinstance(x, torch.Tensor) and x.dtype == self.cast_dtype:
+                return x.float()
+            if isinstance(x, list):
+                return [_upcast(t) for t in x]
+            return x
+        return [_upcast(x) for x in inputs]
+
 
+    def write_outputs(self, plan, outputs):
+        reg = self.tensor_registry
+        for replay_t_id, output in zip(plan.output_writebacks, outputs):
+            if replay_t_id is not None:
+                reg[replay_t_id] = output
 
-    def run_op(self, node):
-        func, output_count = self.funcs[node.id]
+
+    def handle_op_error(self, node, plan, inputs, e):
+        """
+            Report an op that failed to run, exits unless the op can be retried. The error is
+            raised again while capturing a CUDA graph so the capture can fall back to eager replay.
+            return: True if the op should be run again through run_op
+        """
+        if self.capturing:
+            raise e
+        if self.cast_dtype is not None and not plan.upcast:
+            # The op may not support low precision (or mixed precision) inputs, run it in float32 from now on
+            print(f"Run op exception Error with {self.cast_dtype} inputs: {e}, node id: {node.id}, falling back to float32")
+            plan.upcast = True
+            func, _ = self.funcs[node.id]
+            if plan.func is not func:
+                # Go back to the op without the pooled out buffer, the buffer would be upcast along
+                # with the inputs and the op would write to a temporary copy of it
+                plan.func = func
+                plan.input_template = plan.input_template[:-1]
+            return True
+        print(f"Run op exception Error: {e}, node id: {node.id}, func: {plan.func}, inputs: {inputs}")
+        exit(1)
+
+
+    def run_op(self, node, plan):
+        func = plan.func
         if not func:
             return
-        inputs = self.get_inputs(node)
+        inputs = self.get_inputs(plan)
 
+        kind = plan.kind
+        if kind == NORMAL_OP:
+            pass
         ######
         # Workaround to eliminate the "strides() called on undefined Tensor" error
-        if node.name == "aten::convolution_backward":
-            inputs[-1] = [True, True, True]
+        elif kind == CONV_BACKWARD_OP:
+            inputs[-1] = CONV_BACKWARD_OUTPUT_MASK
         ######
-
         # Workaround to handle tensors are on different devices
-        if node.name == "aten::mul":
+        elif kind == MUL_OP:
             if inputs[0].is_cuda ^ inputs[1].is_cuda:
                 if inputs[0].is_cuda:
                     inputs[1] = inputs[1].to(self.cuda)
                 else:
                     inputs[1] = inputs[1].to('cpu')
+        if plan.upcast:
+            inputs = self.upcast_inputs(inputs)
 
         try:
-            outputs = []
-            if output_count == 0:
-                func(*inputs)
-            else:
-                if output_count == 1:
-                    tmp = (func(*inputs),)
-                else:
-                    tmp = func(*inputs)
-                # Flatten any tensor lists
-                # TODO: Simplify this
-                for x in tmp:
-                    if isinstance(x, list) and isinstance(x[0], torch.Tensor):
-                        outputs.extend(x)
-                    elif isinstance(x, torch.Tensor):
-                        outputs.append(x)
+            outputs = flatten_outputs(func(*inputs), plan.output_count)
         except Exception as e:
-            print(f"Run op exception Error: {e}, node id: {node.id}, func: {func}, inputs: {inputs}")
-            exit(1)
+            if self.handle_op_error(node, plan, inputs, e):
+                return self.run_op(node, plan)
 
-        for (_, t_id, _), output in zip(get_output_tensors(node), outputs):
-            if t_id in self.dependency_permanent.keys() and self.tensors_mapping[(node.id, t_id)] not in self.unchangeable_intermediate_tensors:
-                if self.tensors_mapping[(node.id, t_id)] not in self.instantiate:
-                    self.tensor_registry[self.tensors_mapping[(node.id, t_id)]] = output
+        self.write_outputs(plan, outputs)
 
         if self.profile_memory:
             self.op_allocated_mem[node] = torch.cuda.memory_allocated(self.cuda) - self.current_allocated_mem
@@ -349,43 +758,248 @@ class ExgrReplayManager:
             self.current_reserved_mem = torch.cuda.memory_reserved(self.cuda)
 
 
+    def run_iteration(self, nodes_and_plans):
+        """
+            Run every node once. Nodes are run inline with the registry and plan fields bound to locals,
+            which saves the run_op and get_inputs calls per node, and single tensor outputs are written
+            back directly. Nodes that need a workaround and memory profiling go through run_op.
+        """
+        run_op = self.run_op
+        if self.profile_memory:
+            for node, plan in nodes_and_plans:
+                run_op(node, plan)
+            return
+
+        reg = self.tensor_registry
+        tensor_type = torch.Tensor
+        write_outputs = self.write_outputs
+        for node, plan in nodes_and_plans:
+            func = plan.func
+            if not func:
+                continue
+            kind = plan.kind
+            if kind == CONV_BACKWARD_OP or kind == MUL_OP or plan.upcast:
+                run_op(node, plan)
+                continue
+
+            inputs = plan.input_template.copy()
+            for pos, replay_t_id in plan.tensor_slots:
+                inputs[pos] = reg[replay_t_id]
+            for pos, replay_t_ids in plan.tensor_list_slots:
+                inputs[pos] = [reg[replay_t_id] for replay_t_id in replay_t_ids]
+            try:
+                out = func(*inputs)
+            except Exception as e:
+                if self.handle_op_error(node, plan, inputs, e):
+                    run_op(node, plan)
+                continue
+
+            output_count = plan.output_count
+            if output_count == 0:
+                continue
+            writebacks = plan.output_writebacks
+            # Common case: a single tensor output
+            if output_count == 1 and isinstance(out, tensor_type):
+                if writebacks and writebacks[0] is not None:
+                    reg[writebacks[0]] = out
+            else:
+                write_outputs(plan, flatten_outputs(out, output_count))
+
+
+    def run_iteration_on_streams(self, nodes_and_plans):
+        streams = self.streams
+        events = self.stream_events
+        reg = self.tensor_registry
+        current_stream = torch.cuda.current_stream(self.cuda)
+        for stream in streams:
+            stream.wait_stream(current_stream)
+
+        for idx, (node, plan) in enumerate(nodes_and_plans):
+            if not plan.func:
+                continue
+            stream = streams[plan.stream_id]
+            if plan.wait_on:
+                for p in plan.wait_on:
+                    stream.wait_event(events[p])
+                # Inputs may come from other streams, keep the allocator from reusing their memory
+                # before this stream is done with them
+                inputs = [reg[replay_t_id] for _, replay_t_id in plan.tensor_slots]
+                for _, replay_t_ids in plan.tensor_list_slots:
+                    inputs.extend(reg[replay_t_id] for replay_t_id in replay_t_ids)
+                for t in inputs:
+                    if t is not None and t.is_cuda:
+                        t.record_stream(stream)
+            with torch.cuda.stream(stream):
+                self.run_op(node, plan)
+            if events[idx] is not None:
+                events[idx].record(stream)
+
+        for stream in streams:
+            current_stream.wait_stream(stream)
+
+
+    def generate_replay_function(self):
+        """
+            Generate straight-line Python code that runs every node once, with the replay tensor ids
+            and argument positions of each node hard-coded, e.g. reg[42] = funcs[7](reg[17], 1, reg[19]).
+            Multi-output and tensor list outputs go through flatten_outputs and write_outputs, nodes
+            that need a workaround call run_op instead.
+            return: a function that runs one replay iteration
+        """
+        lines = ["def _replay(reg, funcs, consts, nodes, plans, run_op, flatten_outputs, write_outputs):"]
+        consts = []
+        generated_count = 0
+        fallback_count = 0
+
+        def _arg(value):
+            if value is None or type(value) in (bool, int):
+                return repr(value)
+            consts.append(value)
+            return f"consts[{len(consts) - 1}]"
+
+        for idx, (node, plan) in enumerate(zip(self.sorted_nodes, self.replay_plans)):
+            if not plan.func:
+                continue
+            if (plan.kind != NORMAL_OP and plan.kind != FBGEMM_FORWARD_OP) or plan.upcast:
+                lines.append(f"    run_op(nodes[{idx}], plans[{idx}])")
+                fallback_count += 1
+                continue
+
+            args = [_arg(value) for value in plan.input_template]
+            for pos, replay_t_id in plan.tensor_slots:
+                args[pos] = f"reg[{replay_t_id}]"
+            for pos, replay_t_ids in plan.tensor_list_slots:
+                args[pos] = "[" + ", ".join(f"reg[{replay_t_id}]" for replay_t_id in replay_t_ids) + "]"
+            call = f"funcs[{idx}]({', '.join(args)})"
+
+            writebacks = plan.output_writebacks
+            single_tensor = plan.output_count == 1 and len(writebacks) == 1 and \
+                node.output_types[0].startswith("Tensor(") and "nullptr" not in node.output_types[0]
+            if single_tensor and writebacks[0] is not None:
+                lines.append(f"    reg[{writebacks[0]}] = {call}")
+            elif not single_tensor and plan.output_count > 0 and any(replay_t_id is not None for replay_t_id in writebacks):
+                lines.append(f"    write_outputs(plans[{idx}], flatten_outputs({call}, {plan.output_count}))")
+            else:
+                lines.append(f"    {call}")
+            generated_count += 1
+
+        if len(lines) == 1:
+            lines.append("    pass")
+        namespace = {}
+        exec(compile("\n".join(lines), "<eg_replay>", "exec"), namespace)
+        replay = namespace["_replay"]
+        funcs = [plan.func for plan in self.replay_plans]
+        print(f"Generated replay code for {generated_count} ops, {fallback_count} ops go through run_op")
+
+        return lambda: replay(self.tensor_registry, funcs, consts, self.sorted_nodes, self.replay_plans,
+                              self.run_op, flatten_outputs, self.write_outputs)
+
+
+    def cuda_graph_supported(self):
+        if self.profile_memory:
+            print("CUDA graph is not used: memory profiling requires running ops one by one")
+            return False
+        if self.cpu_tensor or any(t is not None and not t.is_cuda for t in self.tensor_registry.values()):
+            print("CUDA graph is not used: replay has CPU tensors")
+            return False
+        for node in self.sorted_nodes:
+            if node.name in CUDA_GRAPH_UNSUPPORTED_OPS:
+                print(f"CUDA graph is not used: {node.name} cannot be captured, node id: {node.id}")
+                return False
+        return True
+
+
+    def capture_cuda_graph(self, nodes_and_plans):
+        """
+            Capture one replay iteration into a CUDA graph, ops write their outputs to the graph's
+            private memory pool so tensor addresses stay the same when the graph is replayed.
+            return: the captured graph, or None if capturing failed
+        """
+        graph = torch.cuda.CUDAGraph()
+        torch.cuda.synchronize()
+        upcast = [plan.upcast for _, plan in nodes_and_plans]
+        self.capturing = True
+        try:
+            with torch.cuda.graph(graph):
+                for node, plan in nodes_and_plans:
+                    self.run_op(node, plan)
+        except Exception as e:
+            print(f"CUDA graph capture error: {e}, falling back to eager replay")
+            # Undo any changes made to the plans during the failed capture
+            for (_, plan), plan_upcast in zip(nodes_and_plans, upcast):
+                plan.upcast = plan_upcast
+            return None
+        finally:
+            self.capturing = False
+        return graph
+
+
     def benchTime(self):
         self.preprocess_graph()
         print("Start to execution: ")
-        time.sleep(10)
+        # Optional idle time before replay, e.g. to let GPU clocks settle. CUDA warmup is already
+        # covered by the warmup iterations.
+        if self.presleep:
+            time.sleep(self.presleep)
         total_time = 0.0
         event_1 = torch.cuda.Event(enable_timing=True)
         event_2 = torch.cuda.Event(enable_timing=True)
+        # Bind to locals to avoid attribute lookups on self in the replay loop
+        nodes_and_plans = tuple(zip(self.sorted_nodes, self.replay_plans))
+        run_iteration = self.run_iteration
+        streams = self.streams
 
         eg_file = "/tmp/replay_eg.json"
         eg = ExecutionGraphObserver()
         eg.register_callback(eg_file)
 
         if self.profile_replay:
+            if self.codegen:
+                print("Replay code is not generated: profiling runs the ops through run_iteration")
+            # Only record the measured iterations, warmup iterations are not profiled. The schedule
+            # needs at least one active step, without measured iterations the profiler records
+            # every step as before.
+            profile_schedule = None
+            eg_step = None
+            if self.numIters > 0:
+                profile_schedule = torch.profiler.schedule(
+                    wait=self.numWarmupIters,
+                    warmup=0,
+                    active=self.numIters,
+                    repeat=1,
+                )
+                # Collect the execution graph of the first iteration the profiler records
+                eg_step = next(
+                    (step for step in range(self.numWarmupIters + self.numIters)
+                        if profile_schedule(step) in (ProfilerAction.RECORD, ProfilerAction.RECORD_AND_SAVE)),
+                    None,
+                )
+
+            def on_step(step):
+                if step == eg_step:
+                    eg.start()
+                elif eg_step is not None and step == eg_step + 1:
+                    eg.stop()
+                    eg.unregister_callback()
+
             with torch.profiler.profile(
                 activities=[
                 torch.profiler.ProfilerActivity.CPU,
                 torch.profiler.ProfilerActivity.CUDA,
                 ],
-                record_shapes=True,
-                # schedule=torch.profiler.schedule(
-                #     skip_first=10,
-                #     wait=10,
-                #     warmup=10,
-                #     active=10,
-                # ),
+                schedule=profile_schedule,
+                record_shapes=self.record_shapes,
+                with_stack=False,
                 on_trace_ready=trace_handler,
                 # profile_memory=True,
             ) as prof:
                 for iter in range(self.numWarmupIters + self.numIters):
-                    if iter == self.numWarmupIters:
-                        eg.start()
-                    if iter == self.numWarmupIters + 1:
-                        eg.stop()
-                        eg.unregister_callback()
+                    on_step(iter)
                     event_1.record()
-                    for node in self.sorted_nodes:
-                        self.run_op(node)
+                    if streams:
+                        self.run_iteration_on_streams(nodes_and_plans)
+                    else:
+                        run_iteration(nodes_and_plans)
                     event_2.record()
                     torch.cuda.synchronize()
                     if iter >= self.numWarmupIters:
@@ -396,29 +1010,77 @@ class ExgrReplayManager:
                     # print(iter, torch.cuda.memory_allocated(self.cuda))
             # print(prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=20))
         else:
-            for iter in range(self.numWarmupIters + self.numIters):
+            # The ops and their tensors are the same in every iteration, so after warmup the
+            # whole iteration can be captured once and replayed without any CPU side dispatch
+            use_cuda_graph = self.cuda_graph and self.cuda_graph_supported()
+            graph = None
+            generated_replay = None
+
+            def replay_iteration():
+                if graph is not None:
+                    graph.replay()
+                elif streams:
+                    self.run_iteration_on_streams(nodes_and_plans)
+                elif generated_replay is not None:
+                    generated_replay()
+                else:
+                    run_iteration(nodes_and_plans)
+
+            for _ in range(self.numWarmupIters):
+                replay_iteration()
+            if use_cuda_graph:
+                graph = self.capture_cuda_graph(nodes_and_plans)
+            if self.codegen and graph is None and not streams:
+                if self.profile_memory:
+                    print("Replay code is not generated: memory profiling runs every op through run_op")
+                else:
+                    # Generated after warmup, so ops that fell back to float32 inputs are already known
+                    generated_replay = self.generate_replay_function()
+                    # Run the generated code once before timing. It calls the ops without any error
+                    # handling, so if it fails, rerun the iteration through run_iteration, which
+                    # handles op errors, and keep using run_iteration.
+                    try:
+                        generated_replay()
+                    except Exception as e:
+                        print(f"Generated replay code error: {e}, falling back to run_iteration")
+                        generated_replay = None
+                        run_iteration(nodes_and_plans)
+            torch.cuda.synchronize()
+
+            if self.per_iter_timing:
+                for _ in range(self.numIters):
+                    event_1.record()
+                    replay_iteration()
+                    event_2.record()
+                    torch.cuda.synchronize()
+                    total_time += event_1.elapsed_time(event_2)
+                    # Comment out this for now since it will introduce additional cudaMalloc
+                    # self.reset_registry()
+            elif self.numIters > 0:
+                # Time all measured iterations with a single event pair, so the CPU does not
+                # synchronize with the GPU between iterations
                 event_1.record()
-                for node in self.sorted_nodes:
-                    self.run_op(node)
+                for _ in range(self.numIters):
+                    replay_iteration()
                 event_2.record()
                 torch.cuda.synchronize()
-                if iter >= self.numWarmupIters:
-                    total_time += event_1.elapsed_time(event_2)
-                # Comment out this for now since it will introduce additional cudaMalloc
-                # self.reset_registry()
+                total_time = event_1.elapsed_time(event_2)
 
         if self.profile_memory:
             print("Allocated GPU memory(B):")
-            for node in dict(sorted(self.op_allocated_mem.items(), key=lambda item: item[1], reverse=True)[:100]):
-                print(node.id, self.op_allocated_mem[node])
+            for node, mem in heapq.nlargest(100, self.op_allocated_mem.items(), key=itemgetter(1)):
+                print(node.id, mem)
             print("Reserved GPU memory(B):")
-            for node in dict(sorted(self.op_reserved_mem.items(), key=lambda item: item[1], reverse=True)[:100]):
-                print(node.id, self.op_reserved_mem[node])
+            for node, mem in heapq.nlargest(100, self.op_reserved_mem.items(), key=itemgetter(1)):
+                print(node.id, mem)
 
-        # print("Replay time{}: {:.2f} ms".format(
-        #     " (profiled)" if self.profile_replay else "",
-        #     total_time / self.numIters
-        # ))
+        if self.numIters > 0:
+            # Profiling always times iterations one by one
+            print("Replay time{}{}: {:.2f} ms".format(
+                " (profiled)" if self.profile_replay else "",
+                " (per iteration timing)" if self.profile_replay or self.per_iter_timing else "",
+                total_time / self.numIters
+            ))
 
 
 def main():
@@ -432,12 +1094,40 @@ def main():
     parser.add_argument(
         "--input", type=str, required=True, help="Input execution graph json file."
     )
+    parser.add_argument(
+        "--presleep", type=float, default=0.0, help="Seconds to sleep before starting replay, warmup iterations already cover CUDA warmup."
+    )
     parser.add_argument(
         "-p", "--profile-replay", action="store_true", help="Profile replay and get trace."
     )
     parser.add_argument(
         "-m", "--profile-memory", action="store_true", help="Profile memory usage in replay."
     )
+    parser.add_argument(
+        "--record-shapes", action="store_true", help="Record input shapes of ops when profiling replay."
+    )
+    parser.add_argument(
+        "--per-iter-timing", action="store_true", help="Time and synchronize every replay iteration separately instead of timing all iterations together."
+    )
+    parser.add_argument(
+        "--cuda-graph", action="store_true", help="Capture the replay iteration into a CUDA graph after warmup. Ignored when profiling."
+    )
+    parser.add_argument(
+        "--num-streams", type=int, default=1, help="Number of CUDA streams to dispatch independent ops on."
+    )
+    cast_group = parser.add_mutually_exclusive_group()
+    cast_group.add_argument(
+        "--cast-fp16", action="store_true", help="Instantiate float32 tensors as float16, ops that fail with them fall back to float32."
+    )
+    cast_group.add_argument(
+        "--cast-bf16", action="store_true", help="Instantiate float32 tensors as bfloat16, ops that fail with them fall back to float32."
+    )
+    parser.add_argument(
+        "--codegen", action="store_true", help="Generate and run straight-line Python code for the replay iteration after warmup. Ignored when profiling."
+    )
+    parser.add_argument(
+        "--buffer-pool", action="store_true", help="Run ops that have an out= overload with preallocated output buffers that are reused across iterations."
+    )
 
     args = parser.parse_args()
 
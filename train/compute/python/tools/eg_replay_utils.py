@@ -2,6 +2,7 @@ import torch
 import io
 import json
 import re
+import sys
 from .execution_graph import NodeType
 from ..lib.config import make_op_config
 from ..lib.pytorch.config_util import (
@@ -74,6 +75,9 @@ def is_backward_aten(op):
 
 
 def fbgemm_input_args_indices(n):
+    # Node invariant and queried several times per fbgemm node, cache it on the node
+    if hasattr(n, "_cached_fbgemm_indices"):
+        return n._cached_fbgemm_indices
     idx_list = None
     if 'sgd' in n.name or 'adagrad' in n.name:
         # exact_sgd: 11: indices, 12: offsets, 14: indice_weights
@@ -81,6 +85,7 @@ def fbgemm_input_args_indices(n):
             idx_list = [11, 12]
         else:
             idx_list = [11, 12, 14]
+    n._cached_fbgemm_indices = idx_list
     return idx_list
 
 
@@ -151,7 +156,7 @@ def execution_graph_handler(output_file_name):
     assert found_root_node
 
 
-def get_input_tensors(n):
+def _parse_input_tensors(n):
     if is_fbgemm_forward(n):
         idx_list = fbgemm_input_args_indices(n)
         return zip([n.input_types[x] for x in idx_list],
@@ -160,7 +165,7 @@ def get_input_tensors(n):
     return n.get_input_tensors()
 
 
-def get_output_tensors(n):
+def _parse_output_tensors(n):
     if is_fbgemm_forward(n):
         return zip(n.output_types,
                     [tuple(x) for x in n.outputs],
@@ -168,6 +173,24 @@ def get_output_tensors(n):
     return n.get_output_tensors()
 
 
+# The tensors of a node are looked up many times during replay preprocessing, parse them once and
+# cache the result on the node. Dtype strings are interned since they are used as dict keys.
+def get_input_tensors(n):
+    tensors = getattr(n, "_cached_in_tensors", None)
+    if tensors is None:
+        tensors = tuple((sys.intern(dtype), t_id, shape) for dtype, t_id, shape in _parse_input_tensors(n))
+        n._cached_in_tensors = tensors
+    return tensors
+
+
+def get_output_tensors(n):
+    tensors = getattr(n, "_cached_out_tensors", None)
+    if tensors is None:
+        tensors = tuple((sys.intern(dtype), t_id, shape) for dtype, t_id, shape in _parse_output_tensors(n))
+        n._cached_out_tensors = tensors
+    return tensors
+
+
 def c10_type_to_str(t):
     if "c10::Half" in t:
         return "fp16"
@@ -270,7 +293,26 @@ def generate_fbgemm_tensors(n):
     return input_args, input_kwargs # Discard weights if not needed
 
 
-def build_torchscript_func(n):
+def has_out_overload(n):
+    """
+        Whether the op has an out= overload that takes the same arguments as the traced schema
+        plus a trailing out tensor, e.g. aten::add.out for aten::add.Tensor.
+    """
+    try:
+        arg_names = [arg.name for arg in torch._C.parse_schema(n.op_schema).arguments]
+        for schema in torch._C._jit_get_schemas_for_operator(n.name):
+            if [arg.name for arg in schema.arguments] == arg_names + ["out"]:
+                return True
+    except Exception:
+        pass
+    return False
+
+
+def build_torchscript_func(n, out=False):
+    """
+        Build a TorchScript function that calls the op, with out=True the function takes an extra
+        trailing tensor argument that is passed to the op's out= overload.
+    """
     input_count = len(n.input_types)
     output_count = len(n.output_types)
 
@@ -292,17 +334,23 @@ def build_torchscript_func(n):
     output_types = [t if t == 'Tensor[]' or 'Tensor' not in t else 'Tensor' for t in output_types]
     # print(n.id, input_types, output_types)
 
+    input_args = ["%{}".format(idx) for idx in range(input_count)]
+    input_decls = ["%{}: {}".format(idx, t) for idx, t in enumerate(input_types)]
+    if out:
+        input_args.append("%{}".format(input_count + output_count))
+        input_decls.append("%{}: Tensor".format(input_count + output_count))
+
     inputStr = """
         graph({}):
             {} = {}({})
             {}
             return (%output)
     """.format(
-        ", ".join(["%{}: {}".format(idx, t) for idx, t in enumerate(input_types)]),
+        ", ".join(input_decls),
         "%output: {}".format(output_types[0]) if output_count == 1 else \
             ", ".join(["%{}: {}".format(idx + input_count, t) for idx, t in enumerate(output_types)]),
         n.name,
-        ", ".join(["%{}".format(idx) for idx in range(input_count)]),
+        ", ".join(input_args),
         "%output : ({}) = prim::TupleConstruct({})".format(
             ", ".join(["Tensor" for _ in range(output_count)]),
             ", ".join(["%{}".format(idx + input_count) for idx in range(output_count)])